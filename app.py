@@ -1,12 +1,19 @@
 # app.py
+import hashlib
+import html
+import io
+import json
 import os
+import shutil
+import threading
 import zipfile
 import tempfile
-from typing import Dict, List, Optional, Tuple
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
 import csv
 
 import gradio as gr
-from PIL import Image
 
 # ---- Expected folder names inside the ZIP ----
 FOLDER_IMAGES = "falses_normalized_rotated"
@@ -25,128 +32,217 @@ REQUIRED_DIRS = [
     FOLDER_REGION,
 ]
 
+# Text folders hold '<image_stem><suffix>' files directly inside the folder.
+TEXT_SUFFIXES = {
+    FOLDER_READ_POSTCODE: "_postcode.txt",
+    FOLDER_READ_WORDS: "_words.txt",
+    FOLDER_REGION: "_words_region_by_addr.txt",
+}
+
 IMG_EXTS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff")
+IMG_EXT_SET = frozenset(ext.lstrip(".") for ext in IMG_EXTS)
 
+# The dataset root is expected near the top of the archive; deeper dirs are not searched.
+MAX_ROOT_DEPTH = 3
+
+# Built indexes are kept here between sessions, one JSON file per archive; only the
+# most recently used INDEX_CACHE_MAX files are kept.
+INDEX_CACHE_DIR = os.path.expanduser("~/.cache/postal_viewer")
+INDEX_CACHE_MAX = 32
+# Bump whenever build_index would produce different entries for the same archive
+# (folder classification, stem parsing, skipped dirs, ...), so old indexes are ignored.
+INDEX_FORMAT_VERSION = 1
+ENTRY_FIELDS = ("key", "image", "postcode_img", "receiver_img", "postcode_txt", "words_txt", "region_txt")
 
-# ----------------- Small helpers -----------------
 
-def read_text_first_line(path: Optional[str]) -> str:
-    if not path or not os.path.isfile(path):
+# ----------------- Small helpers -----------------
+# Nothing is extracted to disk: files are read straight out of the open ZipFile
+# by archive member name when the viewer needs them. The only files written are
+# display-sized image copies in the session's scratch dir, which Gradio serves
+# as-is. Members of an open archive never change, so each session memoizes its
+# display image paths in state["image_paths"] and each entry keeps its formatted
+# text HTML (see entry_html), which makes Prev/Next instant. Both live on the
+# session state and go away with it when another archive is loaded.
+
+def _read_text(zf: zipfile.ZipFile, name: str, first_line: bool = False) -> str:
+    """
+    Read and decode a text member in one go. 'utf-8-sig' drops a leading BOM and
+    is otherwise plain UTF-8; undecodable bytes are ignored. With 'first_line',
+    only as many small chunks are inflated as it takes to reach the first line end.
+    """
+    with zf.open(name) as f:
+        if not first_line:
+            data = f.read()
+        else:
+            # Like text-mode readline(), a line ends at '\n', '\r\n' or a lone '\r'.
+            data = f.read(512)
+            while b"\n" not in data and b"\r" not in data:
+                chunk = f.read(512)
+                if not chunk:
+                    break
+                data += chunk
+            data = data.split(b"\n", 1)[0].split(b"\r", 1)[0]
+    return data.decode("utf-8-sig", errors="ignore")
+
+
+def read_text_first_line(zf: zipfile.ZipFile, name: Optional[str]) -> str:
+    if not name:
         return "_"
-    try:
-        with open(path, "r", encoding="utf-8") as f:
-            line = f.readline().strip()
-            return line if line else "_"
-    except Exception:
-        try:
-            with open(path, "r", encoding="utf-8-sig") as f:
-                line = f.readline().strip()
-                return line if line else "_"
-        except Exception:
-            with open(path, "r", encoding="utf-8", errors="ignore") as f:
-                line = f.readline().strip()
-                return line if line else "_"
+    line = _read_text(zf, name, first_line=True).strip()
+    return line if line else "_"
 
 
-def read_text_all(path: Optional[str]) -> str:
-    if not path or not os.path.isfile(path):
+def read_text_all(zf: zipfile.ZipFile, name: Optional[str]) -> str:
+    if not name:
         return "_"
+    content = _read_text(zf, name).strip()
+    return content if content else "_"
+
+
+def _display_jpeg(zf: zipfile.ZipFile, name: str, max_side: int) -> Optional[bytes]:
+    """
+    Return JPEG bytes for an image member that fit within 'max_side'. JPEGs that
+    are already small enough and carry no EXIF orientation are passed through
+    untouched; anything else is decoded, downscaled and re-encoded.
+    """
+    from PIL import Image  # only needed once an image is shown; keeps startup light
+
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            content = f.read().strip()
-            return content if content else "_"
-    except Exception:
-        try:
-            with open(path, "r", encoding="utf-8-sig") as f:
-                content = f.read().strip()
-                return content if content else "_"
-        except Exception:
-            with open(path, "r", encoding="utf-8", errors="ignore") as f:
-                content = f.read().strip()
-                return content if content else "_"
-
-
-def load_image(path: Optional[str], max_side: int = 900) -> Optional[Image.Image]:
-    """Safely load an image. Returns a PIL Image or None. Avoids opening directories."""
-    if not path or not os.path.isfile(path):
-        return None
-    try:
-        with Image.open(path) as im:
-            img = im.convert("RGB")
-            w, h = img.size
-            scale = min(1.0, max_side / max(w, h))
-            if scale < 1.0:
-                img = img.resize((int(w * scale), int(h * scale)))
-            return img.copy()  # detach from context manager
+        with zf.open(name) as f:
+            data = f.read()
+        with Image.open(io.BytesIO(data)) as im:
+            # Pass small JPEGs through only without an EXIF rotation: the browser would
+            # apply it, while re-encoded images (and the original viewer) never did.
+            if im.format == "JPEG" and max(im.size) <= max_side and im.getexif().get(0x0112, 1) == 1:
+                return data
+            # For JPEGs, let libjpeg downscale by 1/2..1/8 while decoding; no-op otherwise.
+            im.draft("RGB", (max_side, max_side))
+            img = im
+            # "P"/"1" only resample with NEAREST, and alpha modes resample premultiplied,
+            # which would blacken transparent pixels; expand those to RGB first.
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            # Otherwise shrink before converting so convert() touches the small image, and
+            # skip it entirely for RGB sources since it copies even when the mode matches.
+            img.thumbnail((max_side, max_side), Image.Resampling.BILINEAR)
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            buf = io.BytesIO()
+            img.save(buf, "JPEG", quality=85, optimize=False)
+            return buf.getvalue()
     except Exception:
         return None
 
 
-def stem(path: str) -> str:
-    return os.path.splitext(os.path.basename(path))[0]
+def load_image(state: dict, name: Optional[str], max_side: int = 900) -> Optional[str]:
+    """
+    Write a display-sized JPEG of an image member into the session's tmpdir once and
+    return its path, so Gradio can serve the file without a PIL decode/re-encode
+    round-trip. Returns None if the member is missing or cannot be decoded.
+    """
+    if not name:
+        return None
+    image_paths = state["image_paths"]
+    if name in image_paths:
+        return image_paths[name]
+    path = None
+    zf = state["zf"]
+    buf = _display_jpeg(zf, name, max_side)
+    if buf is None and zf.fp is None:
+        return None  # archive closed under a late prefetch; not the member's fault, don't memoize
+    if buf is not None:
+        path = os.path.join(state["tmpdir"], hashlib.blake2b(name.encode("utf-8"), digest_size=8).hexdigest() + ".jpg")
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"  # prefetch threads may race on the same member
+        with open(tmp_path, "wb") as f:
+            f.write(buf)
+        os.replace(tmp_path, path)
+    image_paths[name] = path
+    return path
+
+
+def _is_skipped_dir(part: str) -> bool:
+    """Hidden dirs and macOS '__MACOSX' shadow trees never hold dataset files."""
+    return part.startswith(".") or part == "__MACOSX"
+
+
+def _zip_dir_tree(names: List[str], max_depth: int) -> Dict[str, Set[str]]:
+    """
+    Map every directory prefix in the archive ('' for the top level, else 'a/b/')
+    up to 'max_depth' levels deep to the names of its immediate subdirectories.
+    Directories without an explicit member entry are inferred from the file paths.
+    Skipped dirs are pruned along with everything below them.
+    """
+    tree: Dict[str, Set[str]] = {"": set()}
+    for name in names:
+        parts = name.split("/", max_depth)[:-1]  # drop the file name (or the unsplit tail)
+        prefix = ""
+        for part in parts:
+            if not part or _is_skipped_dir(part):
+                break
+            tree.setdefault(prefix, set()).add(part)
+            prefix = f"{prefix}{part}/"
+            tree.setdefault(prefix, set())
+    return tree
 
 
-def find_zip_root_with_required_dirs(extracted_dir: str) -> Optional[str]:
+def find_zip_root_with_required_dirs(names: List[str]) -> Optional[str]:
     """
-    Return a directory that contains ALL required subdirs.
-    1) Try the top-level extracted_dir
-    2) Search deeper for a dir that contains all required dirs
+    Return the archive prefix ('' or 'some/dir/') that contains ALL required subdirs.
+    The directory tree is searched breadth-first from the top level, so the
+    shallowest match wins, and no deeper than MAX_ROOT_DEPTH levels.
     """
-    if all(os.path.isdir(os.path.join(extracted_dir, d)) for d in REQUIRED_DIRS):
-        return extracted_dir
-    for root, dirs, _files in os.walk(extracted_dir):
-        if all(os.path.isdir(os.path.join(root, d)) for d in REQUIRED_DIRS):
-            return root
+    tree = _zip_dir_tree(names, MAX_ROOT_DEPTH + 1)
+    queue = deque([""])
+    while queue:
+        prefix = queue.popleft()
+        subdirs = tree[prefix]
+        if all(d in subdirs for d in REQUIRED_DIRS):
+            return prefix
+        if prefix.count("/") < MAX_ROOT_DEPTH:
+            queue.extend(f"{prefix}{d}/" for d in sorted(subdirs))
     return None
 
 
-def collect_images(images_dir: str) -> Dict[str, str]:
-    """Recursively collect images, mapping filename stem (case-insensitive) to full path."""
-    image_map: Dict[str, str] = {}
-    if not os.path.isdir(images_dir):
-        return image_map
-    for dirpath, _dirs, files in os.walk(images_dir):
-        for name in files:
-            if name.lower().endswith(IMG_EXTS):
-                p = os.path.join(dirpath, name)
-                if os.path.isfile(p):
-                    image_map[stem(p).lower()] = p
-    return image_map
-
-
-def find_by_stem_case_insensitive(folder: str, base: str) -> Optional[str]:
+def _index_folders(names: List[str], root: str) -> Dict[str, Dict[str, str]]:
     """
-    Find a file in 'folder' whose stem matches 'base', case-insensitive,
-    regardless of extension case.
+    Classify every member under 'root' into its required folder in a single pass.
+    Returns {folder: {key: member name}} where the key is:
+      - images folder: lowercase stem of any image file, searched recursively
+      - crop folders:  lowercase stem of any file; the shallowest member wins
+      - text folders:  exact image stem, taken from '<stem><suffix>' top-level files
     """
-    if not folder or not os.path.isdir(folder):
-        return None
-    base_low = base.lower()
-    try:
-        for name in os.listdir(folder):
-            p = os.path.join(folder, name)
-            if not os.path.isfile(p):
-                continue
-            # match by stem only
-            if stem(name).lower() == base_low:
-                return p
-        # if not found at top level, walk deeper:
-        for dirpath, _dirs, files in os.walk(folder):
-            for name in files:
-                p = os.path.join(dirpath, name)
-                if os.path.isfile(p) and stem(name).lower() == base_low:
-                    return p
-    except PermissionError:
-        # If the folder has restricted entries, just skip them.
-        return None
-    return None
+    index: Dict[str, Dict[str, str]] = {d: {} for d in REQUIRED_DIRS}
+    depth: Dict[str, Dict[str, int]] = {FOLDER_POSTCODE_IMG: {}, FOLDER_RECEIVER_IMG: {}}
+    for n in names:
+        if not n.startswith(root) or n.endswith("/"):
+            continue
+        parts = n[len(root):].split("/")
+        if len(parts) < 2 or parts[0] not in index or any(_is_skipped_dir(p) for p in parts[1:-1]):
+            continue
+        folder, base = parts[0], parts[-1]
+
+        if folder == FOLDER_IMAGES:
+            k, dot, ext = base.rpartition(".")
+            if dot and ext.lower() in IMG_EXT_SET:
+                index[folder][k.lower()] = n
+        elif folder in depth:
+            k, dot, _ = base.rpartition(".")
+            k = (k if dot and k.strip(".") else base).lower()  # like splitext, '.name' has no extension
+            level = len(parts)
+            if level < depth[folder].get(k, level + 1):
+                depth[folder][k] = level
+                index[folder][k] = n
+        elif len(parts) == 2 and base.endswith(TEXT_SUFFIXES[folder]):
+            index[folder][base[:-len(TEXT_SUFFIXES[folder])]] = n
+    return index
 
 
 # ----------------- Index building -----------------
 
-def build_index(root: str) -> Dict:
+def build_index(zf: zipfile.ZipFile, root: str) -> Dict:
     """
-    Build index based on 'falses_normalized_rotated' as the reference set.
+    Build index based on 'falses_normalized_rotated' as the reference set,
+    purely from the archive's member names (nothing is decompressed here).
     For each base name A:
       - image: A.(ext)
       - postcode crop: same stem in 'postcode_img_preprocessed' (any ext)
@@ -155,59 +251,123 @@ def build_index(root: str) -> Dict:
       - words txt:    'read_words/A_words.txt' (entire content)
       - region txt:   'address_region_pred/A_words_region_by_addr.txt' (first line)
     """
-    images_dir = os.path.join(root, FOLDER_IMAGES)
-    pcode_img_dir = os.path.join(root, FOLDER_POSTCODE_IMG)
-    recv_img_dir = os.path.join(root, FOLDER_RECEIVER_IMG)
-    read_postcode_dir = os.path.join(root, FOLDER_READ_POSTCODE)
-    read_words_dir = os.path.join(root, FOLDER_READ_WORDS)
-    region_dir = os.path.join(root, FOLDER_REGION)
-
-    image_map = collect_images(images_dir)
+    index = _index_folders(zf.namelist(), root)
+    image_map = index[FOLDER_IMAGES]
     keys = sorted(image_map.keys())
 
+    pcode_map = index[FOLDER_POSTCODE_IMG]
+    recv_map = index[FOLDER_RECEIVER_IMG]
+    pc_map = index[FOLDER_READ_POSTCODE]
+    w_map = index[FOLDER_READ_WORDS]
+    r_map = index[FOLDER_REGION]
+
     entries = []
     for k_low in keys:
         # k_low is lowercase stem
         k_path = image_map.get(k_low)
-        k = stem(k_path) if k_path else k_low  # keep original case (nice for header)
+        # keep original case (nice for header); image members always have an extension
+        k = k_path[k_path.rfind("/") + 1:k_path.rfind(".")]
 
         # NOTE: For an image like 'my_file.png', 'k' would be 'my_file'.
 
         # EXPECTS: A file in 'postcode_img_preprocessed' with the same stem (e.g., 'my_file.jpg')
-        postcode_img = find_by_stem_case_insensitive(pcode_img_dir, k)
+        postcode_img = pcode_map.get(k_low)
         
         # EXPECTS: A file in 'receiver_img_preprocessed' with the same stem (e.g., 'my_file.bmp')
-        receiver_img = find_by_stem_case_insensitive(recv_img_dir, k)
+        receiver_img = recv_map.get(k_low)
 
         # EXPECTS: A file in 'read_postcode' named exactly '<image_stem>_postcode.txt' (e.g., 'my_file_postcode.txt')
-        postcode_txt = os.path.join(read_postcode_dir, f"{k}_postcode.txt")
+        postcode_txt = pc_map.get(k)
         
         # EXPECTS: A file in 'read_words' named exactly '<image_stem>_words.txt' (e.g., 'my_file_words.txt')
-        words_txt = os.path.join(read_words_dir, f"{k}_words.txt")
+        words_txt = w_map.get(k)
 
         # EXPECTS: A file in 'address_region_pred' named exactly '<image_stem>_words_region_by_addr.txt'
         # (e.g., 'my_file_words_region_by_addr.txt')
-        region_txt = os.path.join(region_dir, f"{k}_words_region_by_addr.txt")
+        region_txt = r_map.get(k)
 
         entries.append({
             "key": k,
             "image": k_path,
             "postcode_img": postcode_img,
             "receiver_img": receiver_img,
-            "postcode_txt": postcode_txt if os.path.isfile(postcode_txt) else None,
-            "words_txt": words_txt if os.path.isfile(words_txt) else None,
-            "region_txt": region_txt if os.path.isfile(region_txt) else None,
+            "postcode_txt": postcode_txt,
+            "words_txt": words_txt,
+            "region_txt": region_txt,
         })
 
+    return _new_state(root, entries)
+
+
+def _new_state(root: str, entries: List[dict]) -> Dict:
+    """Fresh viewer state for an indexed archive, positioned on the first entry."""
     return {
         "root": root,
         "entries": entries,
         "n": len(entries),
         "i": 0,  # current index pointer
-        "annotations": {},  # ADDED: {key: {"label": str, "explanation": str}}
+        "keys": [e["key"] for e in entries],  # dropdown choices, built once
+        "key_to_index": {e["key"]: idx for idx, e in enumerate(entries)},  # O(1) jumps in goto_key
     }
 
 
+def _zip_fingerprint(zf: zipfile.ZipFile, root: str) -> str:
+    """
+    Hash the member names and CRCs from the central directory (nothing is decompressed),
+    together with the root and the index format version.
+    """
+    h = hashlib.blake2b(f"{INDEX_FORMAT_VERSION}:{root}".encode("utf-8"), digest_size=8)
+    for info in zf.infolist():
+        h.update(info.filename.encode("utf-8"))
+        h.update(info.CRC.to_bytes(4, "little"))
+    return h.hexdigest()
+
+
+def load_or_build_index(zf: zipfile.ZipFile, root: str) -> Dict:
+    """
+    Return build_index(zf, root), reusing an index saved by an earlier session for
+    an archive with identical contents. The cache is best effort: any read or
+    write failure just falls back to building the index.
+    """
+    cache_path = os.path.join(INDEX_CACHE_DIR, f"{_zip_fingerprint(zf, root)}.json")
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            entries = json.load(f)
+        if not isinstance(entries, list) or not all(
+            isinstance(e, dict) and set(e) == set(ENTRY_FIELDS) and isinstance(e["key"], str)
+            for e in entries
+        ):
+            raise ValueError(f"malformed index cache: {cache_path}")
+        os.utime(cache_path)  # mark as recently used for _prune_index_cache
+        return _new_state(root, entries)
+    except Exception:
+        pass
+
+    state = build_index(zf, root)
+    try:
+        os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state["entries"], f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+        _prune_index_cache()
+    except Exception:
+        pass
+    return state
+
+
+def _prune_index_cache() -> None:
+    """Delete all but the INDEX_CACHE_MAX most recently used cached indexes."""
+    with os.scandir(INDEX_CACHE_DIR) as it:
+        files = [e for e in it if e.is_file(follow_symlinks=False) and e.name.endswith(".json")]
+    files.sort(key=lambda e: e.stat().st_mtime, reverse=True)
+    for e in files[INDEX_CACHE_MAX:]:
+        try:
+            os.remove(e.path)
+        except OSError:
+            pass
+
+
 # ----------------- Gradio callbacks -----------------
 
 def show_current(state: dict, show_debug: bool):
@@ -225,18 +385,17 @@ def show_current(state: dict, show_debug: bool):
     e = state["entries"][i]
     key = e["key"]
 
-    main_img = load_image(e["image"])
-    pc_img = load_image(e["postcode_img"])
-    rc_img = load_image(e["receiver_img"])
+    if state.get("last_shown_i") == i:
+        # Same entry as on screen (e.g. the dropdown echoing a load): leave media untouched.
+        main_img = pc_img = rc_img = words_html = postcode_html = region_html = gr.update()
+    else:
+        main_img = load_image(state, e["image"])
+        pc_img = load_image(state, e["postcode_img"])
+        rc_img = load_image(state, e["receiver_img"])
 
-    postcode = read_text_first_line(e["postcode_txt"])
-    words = read_text_all(e["words_txt"])
-    region = read_text_first_line(e["region_txt"])
-
-    # Persian RTL HTML blocks
-    words_html = f'<div dir="rtl" style="text-align:right; white-space:pre-wrap;">{words}</div>'
-    postcode_html = f'<div dir="rtl" style="text-align:right;">{postcode}</div>'
-    region_html = f'<div dir="rtl" style="text-align:right;">{region}</div>'
+        words_html, postcode_html, region_html = entry_html(state["zf"], e)
+        state["last_shown_i"] = i
+        prefetch_neighbours(state)
 
     header = f"{key}  ({i+1}/{n})"
 
@@ -253,10 +412,9 @@ def show_current(state: dict, show_debug: bool):
             f"</pre>"
         )
 
-    # Load current annotation
-    annotation = state.get("annotations", {}).get(key, {})
-    label = annotation.get("label")
-    explanation = annotation.get("explanation", "")
+    # Load current annotation (stored on the entry by save_annotation)
+    label = e.get("label")
+    explanation = e.get("explanation", "")
 
     # If a label exists, show the explanation box if it's "Wrong"
     explanation_visible = (label == "Wrong")
@@ -267,13 +425,80 @@ def show_current(state: dict, show_debug: bool):
             gr.update(interactive=True))
 
 
-def load_zip_and_prepare(zip_file, show_debug: bool):
+def entry_html(zf: zipfile.ZipFile, e: dict) -> Tuple[str, str, str]:
     """
-    1) Extract ZIP to a temp dir
-    2) Find the root that contains the 6 folders
-    3) Build index and show first item
+    Return the (words, postcode, region) HTML blocks for an entry. The text is
+    escaped once and the result is stored on the entry, so revisits are free.
+    """
+    if e.get("html") is None:
+        words = html.escape(read_text_all(zf, e["words_txt"]))
+        postcode = html.escape(read_text_first_line(zf, e["postcode_txt"]))
+        region = html.escape(read_text_first_line(zf, e["region_txt"]))
+
+        # Persian RTL HTML blocks
+        e["html"] = (
+            f'<div dir="rtl" style="text-align:right; white-space:pre-wrap;">{words}</div>',
+            f'<div dir="rtl" style="text-align:right;">{postcode}</div>',
+            f'<div dir="rtl" style="text-align:right;">{region}</div>',
+        )
+    return e["html"]
+
+
+def _warm_entry(state: dict, e: dict) -> None:
+    """Load an entry's images and texts so the next show_current hits the caches."""
+    for name in (e["image"], e["postcode_img"], e["receiver_img"]):
+        load_image(state, name)
+    entry_html(state["zf"], e)
+
+
+# A small shared pool keeps rapid Prev/Next clicks from piling up threads, and the
+# in-flight set keeps an entry from being warmed twice at the same time.
+_prefetch_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="prefetch")
+_prefetching: Set[Tuple[int, int]] = set()
+_prefetching_lock = threading.Lock()
+
+
+def _prefetch_entry(state: dict, j: int) -> None:
+    try:
+        _warm_entry(state, state["entries"][j])
+    finally:
+        with _prefetching_lock:
+            _prefetching.discard((id(state["zf"]), j))
+
+
+def prefetch_neighbours(state: dict) -> None:
+    """Warm the caches for the previous and next entries in the background."""
+    i, n = state["i"], state["n"]
+    for j in {(i + 1) % n, (i - 1) % n} - {i}:
+        task = (id(state["zf"]), j)
+        with _prefetching_lock:
+            if task in _prefetching:
+                continue
+            _prefetching.add(task)
+        _prefetch_pool.submit(_prefetch_entry, state, j)
+
+
+def _release_session(state: dict) -> None:
+    """Close the archive and remove the scratch dir of a session whose state is being replaced."""
+    if not state:
+        return
+    if state.get("zf") is not None:
+        state["zf"].close()
+    if state.get("tmpdir"):
+        shutil.rmtree(state["tmpdir"], ignore_errors=True)
+
+
+def load_zip_and_prepare(zip_file, show_debug: bool, prev_state: dict, progress=gr.Progress()):
+    """
+    1) Open the ZIP (nothing is extracted up front)
+    2) Find the root that contains the 6 folders from the member names
+    3) Build index and show first item; files are read from the archive on demand
+    Each step is reported through Gradio's progress bar. A new state releases the
+    previous session right before returning; an unreadable upload leaves a loaded
+    dataset in place instead.
     """
     if zip_file is None:
+        _release_session(prev_state)
         empty = (None, None, None, "", "", "", {}, "Please upload a ZIP first.", "",
                  gr.update(value=None, interactive=False), gr.update(value="", interactive=False, visible=False), gr.update(interactive=False))
         dropdown_update = gr.update(choices=[], value=None)
@@ -282,7 +507,18 @@ def load_zip_and_prepare(zip_file, show_debug: bool):
         return (*empty, dropdown_update, status, export_btn_update)
 
     zip_path = getattr(zip_file, "name", None) or str(zip_file)
-    if not os.path.isfile(zip_path):
+    progress(0.0, desc="Reading archive")
+    try:
+        zf = zipfile.ZipFile(zip_path, "r") if os.path.isfile(zip_path) else None
+    except zipfile.BadZipFile:
+        zf = None
+    if zf is None:
+        if prev_state and prev_state.get("n", 0) > 0:
+            # Like an upload that fails to open at all: keep the loaded dataset on screen.
+            keep = gr.update()
+            return (keep, keep, keep, keep, keep, keep, prev_state, keep, keep,
+                    keep, keep, keep, keep, "Invalid ZIP file; keeping the current dataset.", keep)
+        _release_session(prev_state)
         empty = (None, None, None, "", "", "", {}, "Invalid ZIP file.", "",
                  gr.update(value=None, interactive=False), gr.update(value="", interactive=False, visible=False), gr.update(interactive=False))
         dropdown_update = gr.update(choices=[], value=None)
@@ -290,12 +526,11 @@ def load_zip_and_prepare(zip_file, show_debug: bool):
         export_btn_update = gr.update(interactive=False)
         return (*empty, dropdown_update, status, export_btn_update)
 
-    tmpdir = tempfile.mkdtemp(prefix="dataset_")
-    with zipfile.ZipFile(zip_path, "r") as zf:
-        zf.extractall(tmpdir)
-
-    root = find_zip_root_with_required_dirs(tmpdir)
+    progress(0.3, desc="Locating required folders")
+    root = find_zip_root_with_required_dirs(zf.namelist())
     if root is None:
+        zf.close()
+        _release_session(prev_state)
         empty = (None, None, None, "", "", "", {}, "Required folders not found in ZIP.", "",
                  gr.update(value=None, interactive=False), gr.update(value="", interactive=False, visible=False), gr.update(interactive=False))
         dropdown_update = gr.update(choices=[], value=None)
@@ -303,10 +538,14 @@ def load_zip_and_prepare(zip_file, show_debug: bool):
         export_btn_update = gr.update(interactive=False)
         return (*empty, dropdown_update, status, export_btn_update)
 
-    state = build_index(root)
-    state["tmpdir"] = tmpdir  # keep alive for session
+    progress(0.5, desc="Indexing entries")
+    state = load_or_build_index(zf, root)
+    state["zf"] = zf  # kept open for the session; members are read on demand
+    state["tmpdir"] = tempfile.mkdtemp(prefix="dataset_")  # scratch space for display images and exports
+    state["image_paths"] = {}  # member name -> display JPEG path (or None), see load_image
 
     if state["n"] == 0:
+        _release_session(prev_state)
         empty = (None, None, None, "", "", "", state, "No images found in falses_normalized_rotated.", "",
                  gr.update(value=None, interactive=False), gr.update(value="", interactive=False, visible=False), gr.update(interactive=False))
         dropdown_update = gr.update(choices=[], value=None)
@@ -314,11 +553,13 @@ def load_zip_and_prepare(zip_file, show_debug: bool):
         export_btn_update = gr.update(interactive=False)
         return (*empty, dropdown_update, status, export_btn_update)
 
+    progress(0.9, desc="Loading first entry")
     _main_img, _pc_img, _rc_img, _words_html, _postcode_html, _region_html, state, _header, _debug_text, label_update, expl_update, save_update = show_current(state, show_debug)
-    keys = [e["key"] for e in state["entries"]]
+    keys = state["keys"]
     dropdown_update = gr.update(choices=keys, value=keys[0] if keys else None)
     status = f"Loaded {state['n']} items."
     export_btn_update = gr.update(interactive=True)
+    _release_session(prev_state)
 
     # The outputs of show_current are now 12, so we can unpack them.
     return (_main_img, _pc_img, _rc_img, _words_html, _postcode_html, _region_html, state, _header, _debug_text,
@@ -345,18 +586,16 @@ def goto_key(state: dict, key: str, show_debug: bool):
     if not state or state.get("n", 0) == 0:
         return (None, None, None, "", "", "", state, "No data.", "",
                 gr.update(interactive=False), gr.update(interactive=False, visible=False), gr.update(interactive=False))
-    if key:
-        for idx, e in enumerate(state["entries"]):
-            if e["key"] == key:
-                state["i"] = idx
-                break
+    idx = state["key_to_index"].get(key) if key else None
+    if idx is not None:
+        state["i"] = idx
     return show_current(state, show_debug)
 
 
 def list_keys(state: dict):
     if not state or state.get("n", 0) == 0:
         return gr.update(choices=[], value=None)
-    keys = [e["key"] for e in state["entries"]]
+    keys = state["keys"]
     return gr.update(choices=keys, value=keys[state["i"]] if 0 <= state["i"] < len(keys) else keys[0])
 
 
@@ -369,23 +608,17 @@ def save_annotation(state: dict, label: str, explanation: str):
     if not state or state.get("n", 0) == 0 or not label:
         return state, "Cannot save: No data or no label selected."
 
-    i = state["i"]
-    key = state["entries"][i]["key"]
-
-    # Ensure annotations dict exists
-    if "annotations" not in state:
-        state["annotations"] = {}
+    e = state["entries"][state["i"]]
+    key = e["key"]
 
-    state["annotations"][key] = {
-        "label": label,
-        "explanation": explanation if label == "Wrong" else "",
-    }
+    e["label"] = label
+    e["explanation"] = explanation if label == "Wrong" else ""
 
     return state, f"Annotation for '{key}' saved."
 
 
 def export_csv(state: dict) -> Tuple[dict, gr.update]:
-    if not state or not state.get("annotations"):
+    if not state or not any(e.get("label") for e in state.get("entries", [])):
         return state, gr.update(value=None)
 
     # Create a temporary file to write the CSV
@@ -396,21 +629,18 @@ def export_csv(state: dict) -> Tuple[dict, gr.update]:
 
     filepath = os.path.join(tmpdir, "annotations.csv")
 
-    # Get all keys from entries to ensure order and completeness
-    all_keys = [e["key"] for e in state.get("entries", [])]
-    annotations = state.get("annotations", {})
-
-    with open(filepath, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow(["image_key", "label", "explanation"])
+    # Walk the entries to ensure order and completeness
+    rows = [("image_key", "label", "explanation")]
+    for e in state.get("entries", []):
+        key = e["key"]
+        if e.get("label"):
+            rows.append((key, e["label"], e.get("explanation", "")))
+        else:
+            # Write a row even if not annotated, to show it was seen but not labeled
+            rows.append((key, "Not Annotated", ""))
 
-        for key in all_keys:
-            annotation = annotations.get(key)
-            if annotation:
-                writer.writerow([key, annotation.get("label", ""), annotation.get("explanation", "")])
-            else:
-                # Write a row even if not annotated, to show it was seen but not labeled
-                writer.writerow([key, "Not Annotated", ""])
+    with open(filepath, "w", newline="", encoding="utf-8", buffering=1 << 20) as f:
+        csv.writer(f).writerows(rows)
 
     return state, gr.update(value=filepath, interactive=True)
 
@@ -432,9 +662,9 @@ with gr.Blocks(title="Postal Data Viewer") as demo:
         key_dropdown = gr.Dropdown(choices=[], label="Jump to key", interactive=True)
 
     with gr.Row():
-        main_img = gr.Image(label="Normalized image (A)", interactive=False, type="pil")
-        pc_img   = gr.Image(label="Postcode box",         interactive=False, type="pil")
-        rc_img   = gr.Image(label="Receiver box",         interactive=False, type="pil")
+        main_img = gr.Image(label="Normalized image (A)", interactive=False, type="filepath")
+        pc_img   = gr.Image(label="Postcode box",         interactive=False, type="filepath")
+        rc_img   = gr.Image(label="Receiver box",         interactive=False, type="filepath")
 
     with gr.Row():
         words_html    = gr.HTML(label="Words (Persian)")
@@ -469,7 +699,7 @@ with gr.Blocks(title="Postal Data Viewer") as demo:
     # Wire up
     load_btn.click(
         load_zip_and_prepare,
-        inputs=[zip_input, show_debug],
+        inputs=[zip_input, show_debug, state],
         outputs=[
             main_img, pc_img, rc_img,
             words_html, postcode_html, region_html,